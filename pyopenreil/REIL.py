@@ -1,11 +1,14 @@
-import sys, os, json, base64, unittest, copy
+import sys, os, json, base64, unittest, copy, random, bisect
 from abc import ABCMeta, abstractmethod
-from sets import Set
+from collections import OrderedDict
 
 # REIL constants
 from IR import *
 from symbolic import *
 
+# optional compiled helpers, None when not built
+from symbolic import _reil_core
+
 # supported arhitectures
 from arch import x86, arm
 
@@ -55,6 +58,67 @@ def log_get():
     return log_mask, log_path    
 
 
+# probability of caching Insn.to_symbolic() results, disabled by default
+def memo_prob_get():
+
+    env_prob = os.getenv('REIL_MEMO_PROB')
+
+    return 0.0 if env_prob is None else float(env_prob)
+
+
+class LRUCache(object):
+    ''' Dict-like cache that keeps limited number of items and removes 
+        least recently used ones first. '''
+
+    def __init__(self, max_size):
+
+        self.max_size, self.items = max_size, OrderedDict()
+
+    def __len__(self):
+
+        return len(self.items)
+
+    def __getitem__(self, key):
+
+        # move item to the end of the list
+        val = self.items[key] = self.items.pop(key)
+
+        return val
+
+    def __setitem__(self, key, val):
+
+        self.items.pop(key, None)
+        self.items[key] = val
+
+        if len(self.items) > self.max_size: self.items.popitem(last = False)
+
+    def clear(self):
+
+        self.items.clear()
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test(self):
+
+        cache = LRUCache(2)
+        cache[1], cache[2] = 'a', 'b'
+
+        # use first item and add another one
+        assert cache[1] == 'a'
+        cache[3] = 'c'
+
+        # check that least recently used item was removed
+        assert len(cache) == 2 and cache[1] == 'a' and cache[3] == 'c'
+        
+        try: 
+
+            cache[2]
+            assert False
+
+        except KeyError: pass
+
+
 class Error(Exception):
 
     pass
@@ -103,6 +167,8 @@ def get_arch(arch):
 
 class Arg(object):
 
+    __slots__ = ( 'type', 'size', 'name', 'val' )
+
     def __init__(self, t = None, size = None, name = None, val = None):
 
         serialized = None        
@@ -144,24 +210,26 @@ class Arg(object):
         elif self.type == A_CONST: return mkstr('%x' % self.get_val())
         elif self.type == A_LOC:   return '%x.%.2x' % self.val
 
-    def get_val(self):
+    # value masks for each REIL size
+    SIZE_MASK = { U1: 0x1, U8: 0xff, U16: 0xffff, 
+                  U32: 0xffffffff, U64: 0xffffffffffffffff }
 
-        mkval = lambda mask: long(self.val & mask)
+    def get_val(self):
 
         if self.type != A_CONST:
 
             raise Error('get_val() is available only for A_CONST')
 
-        if self.size == U1:    return 0 if mkval(0x1) == 0 else 1
-        elif self.size == U8:  return mkval(0xff)
-        elif self.size == U16: return mkval(0xffff)
-        elif self.size == U32: return mkval(0xffffffff)
-        elif self.size == U64: return mkval(0xffffffffffffffff)
+        if _reil_core is not None: return _reil_core.get_val(self.val, self.size)
+
+        val = long(self.val & self.SIZE_MASK[self.size])
+
+        return (1 if val != 0 else 0) if self.size == U1 else val
 
     def is_var(self):
 
         # check for temporary or target architecture register
-        return self.type == A_REG or self.type == A_TEMP
+        return A_REG <= self.type <= A_TEMP
 
     def size_name(self):
 
@@ -178,23 +246,21 @@ class Arg(object):
 
         if len(data) == 3:
       
-            self.type, self.size = Arg_type(data), Arg_size(data)
+            self.type, self.size, val = data
 
-            if self.size not in [ U1, U8, U16, U32, U64 ]:
+            if self.size not in self.SIZE_MASK:
 
                 return False
             
-            if self.type == A_REG:     self.name = Arg_name(data)
-            elif self.type == A_TEMP:  self.name = Arg_name(data)
-            elif self.type == A_CONST: self.val = Arg_val(data)
+            if A_REG <= self.type <= A_TEMP: self.name = val
+            elif self.type == A_CONST:       self.val = val
             else: 
 
                 return False
 
         elif len(data) == 2:
 
-            self.type = Arg_type(data)
-            addr, inum = Arg_loc(data)
+            self.type, ( addr, inum ) = data
 
             if self.type == A_LOC: 
 
@@ -223,7 +289,7 @@ class Arg(object):
                 name += '_%x' % insn.addr
 
             # register value
-            arg = SymVal(name, self.size, is_temp = self.type == A_TEMP)
+            arg = mk_val(name, self.size, is_temp = self.type == A_TEMP)
 
             if in_state is not None:
 
@@ -236,7 +302,7 @@ class Arg(object):
         elif self.type == A_CONST:
 
             # constant value
-            return SymConst(self.get_val(), self.size)
+            return mk_const(self.get_val(), self.size)
 
         elif self.type == A_LOC:
 
@@ -248,9 +314,15 @@ class Arg(object):
 
 class Insn(object):    
 
+    __slots__ = ( 'attr', 'op', 'size', 'addr', 'inum', 'a', 'b', 'c' )
+
     ATTR_DEFS = (( IATTR_FLAGS, 0 ), # optional REIL flags
                  )
 
+    # to_symbolic() results for already seen (instruction, input state) pairs
+    symbolic_cache = LRUCache(0x1000)
+    symbolic_cache_prob = memo_prob_get()
+
     class IRAddr(tuple):
 
         def __str__(self):
@@ -350,7 +422,7 @@ class Insn(object):
         if show_bin:
 
             ret += '; data (%d): %s\n' % (self.size,
-                   ' '.join(map(lambda b: '%.2x' % ord(b), self.get_attr(IATTR_BIN))))
+                   ' '.join([ '%.2x' % ord(b) for b in self.get_attr(IATTR_BIN) ]))
 
         if show_hdr: ret += ';\n'
 
@@ -375,22 +447,23 @@ class Insn(object):
 
     def unserialize(self, data):
 
-        self.init_attr(Insn_attr(data))
-        self.addr, self.inum, self.size = Insn_addr(data), Insn_inum(data), Insn_size(data)
+        ( self.addr, self.size ), self.inum, self.op, args, attr = data
+
+        self.init_attr(attr)
 
-        self.op = Insn_op(data)
         if self.op > len(REIL_INSN) - 1: 
 
             raise ParseError(self.addr)
 
-        args = Insn_args(data) 
         if len(args) != 3: 
 
             raise ParseError(self.addr)
 
-        if not self.a.unserialize(args[0]) or \
-           not self.b.unserialize(args[1]) or \
-           not self.c.unserialize(args[2]): 
+        a, b, c = args
+
+        if not self.a.unserialize(a) or \
+           not self.b.unserialize(b) or \
+           not self.c.unserialize(c): 
 
            raise ParseError(self.addr)
 
@@ -427,100 +500,203 @@ class Insn(object):
 
     def has_flag(self, val):
 
-        return self.get_attr(IATTR_FLAGS) & val != 0    
+        return (self.attr[IATTR_FLAGS] & val) != 0
 
     def args(self):
 
         return self.src() + self.dst()
 
-    def dst(self, get_all = False):
+    # instructions that are using c argument as source instead of destination
+    OPS_C_IS_SRC = frozenset(( I_JCC, I_STM ))
 
-        ret = []
+    def dst(self, get_all = False):
 
-        if self.op not in [ I_UNK, I_NONE ]: 
+        if self.op == I_UNK:
 
-            if get_all: cond = lambda arg: arg.type != A_NONE 
-            else: cond = lambda arg: arg.is_var()
+            # get operands information from attributes
+            return map(Arg, self.get_attr(IATTR_DST)) if self.has_attr(IATTR_DST) else []
 
-            if self.op != I_JCC and self.op != I_STM and \
-               cond(self.c): ret.append(self.c)
+        if self.op == I_NONE or self.op in self.OPS_C_IS_SRC: 
 
-        if self.op == I_UNK and self.has_attr(IATTR_DST):
+            return []
 
-            # get operands information from attributes
-            ret = map(lambda a: Arg(a), self.get_attr(IATTR_DST))
+        c = self.c
 
-        return ret
+        return [ c ] if (c.type != A_NONE if get_all else c.is_var()) else []
 
     def src(self, get_all = False):
 
-        ret = []
+        if self.op == I_UNK:
 
-        if self.op not in [ I_UNK, I_NONE ]: 
+            # get operands information from attributes
+            return map(Arg, self.get_attr(IATTR_SRC)) if self.has_attr(IATTR_SRC) else []
 
-            if get_all: cond = lambda arg: arg.type != A_NONE 
-            else: cond = lambda arg: arg.is_var()
+        if self.op == I_NONE: 
 
-            if cond(self.a): ret.append(self.a)
-            if cond(self.b): ret.append(self.b)
+            return []
 
-            if (self.op == I_JCC or self.op == I_STM) and \
-               cond(self.c): ret.append(self.c)
+        if get_all: cond = lambda arg: arg.type != A_NONE 
+        else: cond = Arg.is_var
 
-        if self.op == I_UNK and self.has_attr(IATTR_DST):
+        ret = [ arg for arg in ( self.a, self.b ) if cond(arg) ]
 
-            # get operands information from attributes
-            ret = map(lambda a: Arg(a), self.get_attr(IATTR_SRC))
+        if self.op in self.OPS_C_IS_SRC and cond(self.c): ret.append(self.c)
 
         return ret
 
+    def _symbolic_key(self, out_state):
+
+        # frozen layers of the state are never modified, their stamp identifies contents
+        stamp = None if out_state.parent is None else out_state.parent.stamp
+        next = self.get_attr(IATTR_NEXT) if self.has_attr(IATTR_NEXT) else None
+
+        # JSON has no tuples, next instruction address might be a list
+        next = None if next is None else tuple(next)
+
+        return ( self.addr, self.inum, self.size, self.op, 
+                 self.a.serialize(), self.b.serialize(), self.c.serialize(),
+                 self.get_attr(IATTR_FLAGS), next, stamp )
+
     def to_symbolic(self, in_state = None):
 
         # copy input state to output state
         out_state = SymState() if in_state is None else in_state.clone()
 
-        # skip instructions that doesn't update output state
-        if not self.op in [ I_NONE, I_UNK ]:
+        if self.symbolic_cache_prob <= 0.0:
 
-            # convert instruction arguments to symbolic expressions
-            a = self.a.to_symbolic(self, out_state)
-            b = self.b.to_symbolic(self, out_state)
-            c = self.c.to_symbolic(self)
+            # cache is disabled, don't pay for the key
+            return self._to_symbolic(out_state)
+
+        key = self._symbolic_key(out_state)
+
+        try: 
+
+            # instruction was already evaluated with the same input state
+            return self.symbolic_cache[key].clone()
+
+        except KeyError: 
+
+            pass
+
+        self._to_symbolic(out_state)
+
+        if self.symbolic_cache_prob >= 1.0 or \
+           random.random() < self.symbolic_cache_prob:
+
+            # cache a copy, caller is free to modify returned state
+            self.symbolic_cache[key] = out_state.clone()
+
+        return out_state
+
+    def _symbolic_str(self, state, a, b, c):
+
+        # move a value to the register
+        state.update(c, a)
+
+    def _symbolic_stm(self, state, a, b, c):
+
+        # memory write
+        state.update_mem_w(c, a, self.a.size)
+
+    def _symbolic_ldm(self, state, a, b, c):
+
+        # memory read
+        state.update_mem_r(c, a, self.c.size)
+
+    def _symbolic_jcc(self, state, a, b, c):
+
+        if not self.c.type in [ A_CONST, A_LOC ]:
+
+            c = state.get(c)
+
+        if type(c) is SymConst:
+
+            # make IR addr from numeric constant
+            c = SymIRAddr(c.val, 0)
+
+        if self.a.type == A_CONST:
+
+            # unconditional
+            if self.a.get_val() != 0: state.update(SymIP(), c)
+
+        else:                    
+
+            true, false = c, SymIRAddr(*self.next())
+            assert true is not None and false is not None
+
+            # conditional
+            state.update(SymIP(), SymCond(a, true, false))
+
+    # unsigned operations for constant folding
+    SYMBOLIC_FOLD = { I_ADD: lambda a, b: a + b,  I_SUB: lambda a, b: a - b,
+                      I_NEG: lambda a, b: -a,     I_MUL: lambda a, b: a * b,
+                      I_DIV: lambda a, b: a / b,  I_MOD: lambda a, b: a % b,
+                      I_SHL: lambda a, b: a << b, I_SHR: lambda a, b: a >> b,
+                      I_AND: lambda a, b: a & b,   I_OR: lambda a, b: a | b,
+                      I_XOR: lambda a, b: a ^ b,  I_NOT: lambda a, b: ~a,
+                       I_EQ: lambda a, b: int(a == b), 
+                       I_LT: lambda a, b: int(a < b) }
 
-            # move a value to the register
-            if self.op == I_STR: out_state.update(c, a)
+    def _symbolic_fold(self, a, b):
 
-            # memory read/write
-            elif self.op == I_STM: out_state.update_mem_w(c, a, self.a.size)
-            elif self.op == I_LDM: out_state.update_mem_r(c, a, self.c.size)            
+        try: fold = self.SYMBOLIC_FOLD[self.op]
+        except KeyError: return None
 
-            # jump
-            elif self.op == I_JCC:
+        mask = Arg.SIZE_MASK
+        size = self.a.size if b is None else max(self.a.size, self.b.size)
 
-                if not self.c.type in [ A_CONST, A_LOC ]:
+        a = a.val & mask[self.a.size]
+        b = None if b is None else b.val & mask[self.b.size]
 
-                    c = out_state.get(c)
+        if self.op in [ I_DIV, I_MOD ] and b == 0: 
 
-                if isinstance(c, SymConst):
+            # keep division by zero as is
+            return None
+
+        if self.op in [ I_SHL, I_SHR ] and b >= mask[size].bit_length():
+
+            # shift result depends on target CPU
+            return None
 
-                    # make IR addr from numeric constant
-                    c = SymIRAddr(c.val, 0)
+        # result wraps around operands size, see VM.Math
+        return fold(a, b) & mask[size] & mask[self.c.size]
 
-                if self.a.type == A_CONST:
+    def _symbolic_exp(self, state, a, b, c):
 
-                    # unconditional
-                    if self.a.get_val() != 0: out_state.update(SymIP(), c)
+        if type(a) is SymConst and (b is None or type(b) is SymConst):
 
-                else:                    
+            # both operands are known, evaluate expression
+            val = self._symbolic_fold(a, b)
 
-                    true, false = c, SymIRAddr(*self.next())
-                    assert true is not None and false is not None
+            if val is not None:
 
-                    # conditional
-                    out_state.update(SymIP(), SymCond(a, true, false))
+                state.update(c, mk_const(val, self.c.size))
+                return
 
-            # other instructions
-            else: out_state.update(c, a.to_exp(self.op, b))
+        # other instructions
+        state.update(c, a.to_exp(self.op, b))
+
+    # instructions that doesn't update symbolic state
+    SYMBOLIC_SKIP = frozenset(( I_NONE, I_UNK ))
+
+    # opcode specific handlers, _symbolic_exp() is used for other opcodes
+    SYMBOLIC_HANDLERS = { I_STR: _symbolic_str, 
+                          I_STM: _symbolic_stm,
+                          I_LDM: _symbolic_ldm,
+                          I_JCC: _symbolic_jcc }
+
+    def _to_symbolic(self, out_state):
+
+        # skip instructions that doesn't update output state
+        if not self.op in self.SYMBOLIC_SKIP:
+
+            # convert instruction arguments to symbolic expressions
+            a = None if self.a.type == A_NONE else self.a.to_symbolic(self, out_state)
+            b = None if self.b.type == A_NONE else self.b.to_symbolic(self, out_state)
+            c = self.c.to_symbolic(self)
+
+            handler = self.SYMBOLIC_HANDLERS.get(self.op, Insn._symbolic_exp)
+            handler(self, out_state, a, b, c)
 
         return out_state
 
@@ -531,19 +707,21 @@ class Insn(object):
             # force to use next instruction that was set in attributes
             return self.get_attr(IATTR_NEXT)
 
-        if self.has_flag(IOPT_RET): 
+        flags = self.attr[IATTR_FLAGS]
+
+        if flags & IOPT_RET: 
 
             # end of function
             return None
 
         elif self.op == I_JCC and \
              self.a.type == A_CONST and self.a.get_val() != 0 and \
-             not self.has_flag(IOPT_CALL):
+             not flags & IOPT_CALL:
 
             # unconditional jump
             return None
 
-        elif self.has_flag(IOPT_ASM_END):
+        elif flags & IOPT_ASM_END:
 
             # go to first IR instruction of next assembly instruction
             return self.IRAddr(( self.next_asm(), 0 ))
@@ -578,7 +756,7 @@ class Insn(object):
 
     def eliminate(self):
 
-        self.op, self.args = I_NONE, {}
+        self.op = I_NONE
         self.a = Arg(A_NONE)
         self.b = Arg(A_NONE)
         self.c = Arg(A_NONE)        
@@ -624,6 +802,17 @@ class TestInsn(unittest.TestCase):
         assert self.test_insn.src() == [ self.test_insn.a ] and \
                self.test_insn.dst() == [ self.test_insn.c ]
 
+        insn = Insn(op = I_STM, a = Arg(A_CONST, U32, val = 1), c = Arg(A_REG, U32, 'R_ECX'))
+
+        # memory write has no destination args
+        assert insn.src() == [ insn.c ] and insn.src(get_all = True) == [ insn.a, insn.c ]
+        assert insn.dst() == [] and insn.dst(get_all = True) == []
+
+        # check unknown instruction with source args only
+        insn = Insn(op = I_UNK, attr = { IATTR_SRC: [ ( A_REG, U32, 'R_ECX' ) ] })
+
+        assert insn.src() == [ Arg(A_REG, U32, 'R_ECX') ] and insn.dst() == []
+
     def test_next(self):  
 
         # check next instruction address
@@ -679,6 +868,97 @@ class TestInsn(unittest.TestCase):
                    == SymPtr(SymAny()) \
                    == SymPtr(SymVal('R_ECX', U32))
 
+        sym = Insn(op = I_STR, \
+                   a = Arg(A_CONST, U32, val = 0xfffffffe), \
+                   c = Arg(A_REG, U32, 'R_EAX')).to_symbolic()
+
+        sym = Insn(op = I_ADD, \
+                   a = Arg(A_REG, U32, 'R_EAX'), \
+                   b = Arg(A_CONST, U32, val = 3), \
+                   c = Arg(A_REG, U32, 'R_ECX')).to_symbolic(sym)
+
+        ecx = sym[SymVal('R_ECX', U32)]
+
+        # check for constant folding
+        assert type(ecx) is SymConst and ecx.val == 1
+
+        sym = Insn(op = I_DIV, \
+                   a = Arg(A_CONST, U32, val = 1), \
+                   b = Arg(A_CONST, U32, val = 0), \
+                   c = Arg(A_REG, U32, 'R_EAX')).to_symbolic()
+
+        # division by zero is not folded
+        assert type(sym[SymVal('R_EAX', U32)]) is SymExp
+
+    def test_to_symbolic_cache(self):
+
+        insn = Insn(op = I_STR, \
+                    a = Arg(A_REG, U32, 'R_ECX'), \
+                    c = Arg(A_REG, U32, 'R_EAX'))
+
+        prob, Insn.symbolic_cache_prob = Insn.symbolic_cache_prob, 0.0
+        Insn.symbolic_cache.clear()
+
+        try:
+
+            # check that disabled cache is not updated
+            insn.to_symbolic()
+            assert len(Insn.symbolic_cache) == 0
+
+            Insn.symbolic_cache_prob = 1.0
+            self._check_to_symbolic_cache()
+
+        finally:
+
+            Insn.symbolic_cache_prob = prob
+
+    def _check_to_symbolic_cache(self):
+
+        insn = Insn(op = I_ADD, \
+                    a = Arg(A_REG, U32, 'R_ECX'), \
+                    b = Arg(A_CONST, U32, val = 1), \
+                    c = Arg(A_REG, U32, 'R_EAX'))
+
+        sym_1 = insn.to_symbolic()
+        sym_2 = insn.to_symbolic()
+
+        # check that cached state is equal but not shared with caller
+        assert sym_1 is not sym_2 and sym_1.arg_out() == sym_2.arg_out()
+        assert sym_2[SymVal('R_EAX', U32)] == SymVal('R_ECX', U32) + SymConst(1, U32)
+
+        sym_1.clear()
+        assert insn.to_symbolic().arg_out() == [ SymVal('R_EAX', U32) ]
+
+        # the same address with other arguments must not hit the cache
+        insn.b = Arg(A_CONST, U32, val = 2)
+        eax = insn.to_symbolic()[SymVal('R_EAX', U32)]
+
+        assert eax == SymVal('R_ECX', U32) + SymConst(2, U32)
+
+        insn = Insn(op = I_STR, \
+                    a = Arg(A_REG, U32, 'R_EAX'), \
+                    c = Arg(A_REG, U32, 'R_ECX'))
+
+        for size in [ U8, U32 ]:
+
+            state = SymState()
+            state.update(mk_val('R_EAX', U32), mk_val('R_EDX', size))
+
+            # states that are different only in values size must not share cache entry
+            ecx = insn.to_symbolic(state)[SymVal('R_ECX', U32)]
+            assert ecx.size == size
+
+            # the same input state must hit the cache
+            assert insn.to_symbolic(state)[SymVal('R_ECX', U32)] is ecx
+
+        assert len(Insn.symbolic_cache) <= Insn.symbolic_cache.max_size
+
+        insn.set_attr(IATTR_NEXT, ( 8, 0 ))
+
+        # check instruction with next address loaded from JSON
+        sym = Insn(InsnJson().to_json(insn)).to_symbolic()
+        assert sym[SymVal('R_ECX', U32)] == SymVal('R_EAX', U32)
+
 
 class TestSymState(unittest.TestCase):   
 
@@ -712,6 +992,42 @@ class TestSymState(unittest.TestCase):
         sym.slice(val_in = [ 'R_EBX' ])
         assert sym.arg_out() == []      
 
+    def test_clone(self):
+
+        eax, ecx, edx = SymVal('R_EAX', U32), SymVal('R_ECX', U32), SymVal('R_EDX', U32)
+
+        sym_1 = SymState()
+        sym_1.update(eax, ecx)
+        sym_1.update(ecx, edx)
+
+        sym_2 = sym_1.clone()
+        sym_2.update(eax, edx)
+        sym_2.clear(ecx)
+
+        # check that changes of the clone are not visible in original state
+        assert sym_1.arg_out() == [ eax, ecx ] and sym_1[eax] == ecx
+        assert sym_2.arg_out() == [ eax ] and sym_2[eax] == edx
+
+        sym_1.update(edx, eax)
+
+        # and vice versa
+        assert sym_2.get(edx) is None and sym_1[edx] == eax
+
+        for i in range(SymState.MAX_DEPTH * 2): 
+
+            sym_2 = sym_2.clone()
+            sym_2.update(eax, edx)
+
+        # check for layers chain flattening
+        assert sym_2.parent.depth < SymState.MAX_DEPTH
+        assert sym_2.arg_out() == [ eax ] and sym_2[eax] == edx
+
+        sym_3 = SymState(sym_1)
+        sym_1.update(eax, edx)
+
+        # copy constructor must not share modifiable layers
+        assert sym_3[eax] == ecx and sym_1[eax] == edx
+
 
 class InsnJson(): 
 
@@ -736,9 +1052,15 @@ class InsnJson():
         attr_new = {}
 
         # make serialized argument from json data
-        arg = lambda a: ( Arg_type(a), \
-                          Arg_size(a), \
-                          Arg_val(a) if Arg_type(a) == A_CONST else Arg_name(a) ) if len(a) > 0 else ()
+        def arg(a):
+
+            if len(a) == 0: return ()
+
+            # JSON has no tuples, jump location is a list
+            if Arg_type(a) == A_LOC: return ( Arg_type(a), tuple(Arg_loc(a)) )
+
+            return ( Arg_type(a), Arg_size(a), \
+                     Arg_val(a) if Arg_type(a) == A_CONST else Arg_name(a) )
         
         insn = json.loads(data)
         attr = Insn_attr(insn)
@@ -792,12 +1114,20 @@ class TestInsnJson(unittest.TestCase):
         # check json parsing
         assert js.from_json(self.json_data) == self.test_data
 
+        # check instruction with jump location
+        insn = Insn(op = I_JCC, size = 2, ir_addr = ( 0, 0 ), \
+                    a = Arg(A_CONST, U1, val = 1), c = Arg(A_LOC, val = ( 8, 0 )))
+
+        assert js.from_json(js.to_json(insn)) == insn.serialize()
+
 
 class InsnList(list):
 
+    __slots__ = ()
+
     def __str__(self):
 
-        return '\n'.join(map(lambda insn: insn.to_str(show_asm = True, show_bin = True), self)) + '\n'
+        return '\n'.join([ insn.to_str(show_asm = True, show_bin = True) for insn in self ]) + '\n'
 
     def sort(self):
 
@@ -909,6 +1239,9 @@ class TestInsnList(unittest.TestCase):
 
 
 class BasicBlock(InsnList):
+
+    # input is set by DFGraphBuilder
+    __slots__ = ( 'first', 'last', 'ir_addr', 'size', 'input' )
     
     def __init__(self, insn_list):
 
@@ -945,6 +1278,132 @@ class BasicBlock(InsnList):
 
         return self.last.next(), self.last.jcc_loc()    
 
+    # compiled basic blocks, see compile_concrete()
+    concrete_cache = LRUCache(0x1000)
+
+    # number of bits for each REIL size
+    SIZE_BITS = { U1: 1, U8: 8, U16: 16, U32: 32, U64: 64 }
+
+    # expressions for I_ADD - I_LT instructions
+    CONCRETE_EXP = { I_ADD: '%s + %s',  I_SUB: '%s - %s',  I_NEG: '-%s',
+                     I_MUL: '%s * %s',  I_DIV: '%s / %s',  I_MOD: '%s %% %s',
+                    I_SMUL: '%s * %s', I_SDIV: '%s / %s', I_SMOD: '%s %% %s',
+                     I_SHL: '%s << %s', I_SHR: '%s >> %s', I_AND: '%s & %s',
+                      I_OR: '%s | %s',  I_XOR: '%s ^ %s',  I_NOT: '~%s',
+                      I_EQ: 'int(%s == %s)', I_LT: 'int(%s < %s)' }
+
+    CONCRETE_SIGNED = frozenset(( I_SMUL, I_SDIV, I_SMOD ))
+
+    def compile_concrete(self):
+        ''' Compile basic block into the Python function fn(regs, mem) that 
+            executes it with concrete values the same way as VM.Cpu does.
+            regs is a dict of registers values by name (missing registers
+            are zero), mem must have VM.Mem compatible load() and store().
+            Function returns IR address of the next instruction to execute. '''
+
+        next = self.last.next()
+
+        # next instruction depends on flags and attributes of the last one,
+        # JSON has no tuples so IATTR_NEXT value might be a list
+        key = ( self.ir_addr, self.size, None if next is None else tuple(next),
+                tuple([ ( insn.op, insn.a.serialize(), 
+                                   insn.b.serialize(), 
+                                   insn.c.serialize() ) for insn in self ]) )
+
+        try: return self.concrete_cache[key]
+        except KeyError: pass
+
+        mask = Arg.SIZE_MASK
+
+        def _signed(val, bits):
+
+            # unsigned value to signed
+            return val - (1 << bits) if val >> (bits - 1) else val
+
+        # constants used by the generated code
+        names = { '_signed': _signed, '_next': self.last.next() }
+
+        def _get(arg):
+
+            if arg.type == A_CONST: 
+
+                return '0x%x' % arg.get_val()
+
+            # temp registers are stored in regs just like in VM.Cpu
+            return '(regs.get(%r, 0) & 0x%x)' % ( arg.name, mask[arg.size] )
+
+        def _set(arg, exp):
+
+            return 'regs[%r] = (%s) & 0x%x' % ( arg.name, exp, mask[arg.size] )
+
+        lines = [ 'def _bb(regs, mem):' ]
+
+        for insn in self:
+
+            a, b, c = insn.a, insn.b, insn.c
+
+            if insn.op == I_NONE:
+
+                continue
+
+            elif insn.op == I_STR:
+
+                line = _set(c, _get(a))
+
+            elif insn.op == I_STM:
+
+                line = 'mem.store(%s, %d, %s)' % ( _get(c), a.size, _get(a) )
+
+            elif insn.op == I_LDM:
+
+                line = _set(c, 'mem.load(%s, %d)' % ( _get(a), c.size ))
+
+            elif insn.op == I_JCC:
+
+                if c.type == A_LOC:
+
+                    loc = '_loc%d' % len(names)
+                    names[loc] = c.val
+
+                else:
+
+                    loc = '( %s, 0 )' % _get(c)
+
+                line = 'if %s != 0: return %s' % ( _get(a), loc )
+
+            elif self.CONCRETE_EXP.has_key(insn.op):
+
+                size = a.size if b.type == A_NONE else max(a.size, b.size)
+                args = ( _get(a), ) if b.type == A_NONE else ( _get(a), _get(b) )
+
+                if insn.op in self.CONCRETE_SIGNED:
+
+                    bits = self.SIZE_BITS[size]
+                    args = tuple([ '_signed(%s, %d)' % ( arg, bits ) for arg in args ])
+
+                    # signed result is sign extended to the destination size
+                    exp = '_signed((%s) & 0x%x, %d)' % ( self.CONCRETE_EXP[insn.op] % args, 
+                                                         mask[size], bits )
+                else:
+
+                    # operation result wraps around operands size
+                    exp = '(%s) & 0x%x' % ( self.CONCRETE_EXP[insn.op] % args, mask[size] )
+
+                line = _set(c, exp)
+
+            else:
+
+                raise Error('Unable to compile instruction %s' % str(insn))
+
+            lines.append('    ' + line)
+
+        lines.append('    return _next')
+
+        exec '\n'.join(lines) + '\n' in names
+
+        fn = self.concrete_cache[key] = names['_bb']
+        return fn
+
 
 class TestBasicBlock(unittest.TestCase):    
 
@@ -998,6 +1457,62 @@ class TestBasicBlock(unittest.TestCase):
         assert lhs == Insn.IRAddr(( 0x05, 4 ))
         assert rhs == Insn.IRAddr(( 0x09, 0 ))
 
+    def test_compile_concrete(self):
+
+        class Mem(dict):
+
+            load = lambda self, addr, size: self[addr]
+            store = lambda self, addr, size, val: self.__setitem__(addr, val)
+
+        mk_insn = lambda inum, op, a = None, b = None, c = None, flags = 0: \
+                  Insn(op = op, size = 2, ir_addr = ( 0x10, inum ), a = a, b = b, c = c,
+                       attr = { IATTR_FLAGS: flags })
+
+        mk_reg = lambda name, size = U32: Arg(A_REG, size, name)
+        mk_temp = lambda name, size = U32: Arg(A_TEMP, size, name)
+        mk_const = lambda val, size = U32: Arg(A_CONST, size, val = val)
+
+        bb = BasicBlock([ mk_insn(0, I_ADD, mk_reg('R_EAX'), mk_reg('R_ECX'), mk_temp('V_00')),
+                          mk_insn(1, I_STR, mk_temp('V_00'), c = mk_reg('R_EAX')),
+                          mk_insn(2, I_STM, mk_reg('R_EAX'), c = mk_reg('R_EDX')),
+                          mk_insn(3, I_LDM, mk_reg('R_EDX'), c = mk_reg('R_ECX')),
+                          mk_insn(4, I_SUB, mk_const(0), mk_const(1), mk_reg('R_EBX')),
+                          mk_insn(5, I_SMUL, mk_reg('R_EBX'), mk_const(2), mk_reg('R_EBX')),
+                          mk_insn(6, I_LT, mk_reg('R_EAX'), mk_const(0x10), mk_temp('V_01', U1)),
+                          mk_insn(7, I_JCC, mk_temp('V_01', U1), c = Arg(A_LOC, val = ( 0x20, 0 )),
+                                  flags = IOPT_ASM_END | IOPT_BB_END) ])
+
+        fn = bb.compile_concrete()
+
+        # check for compiled code cache
+        assert BasicBlock(list(bb)).compile_concrete() is fn
+
+        insn = bb.last.clone()
+        insn.set_flag(IOPT_RET)
+
+        # the same instructions with other next address must be compiled again
+        assert BasicBlock(list(bb[: -1]) + [ insn ]).compile_concrete()({ 'R_EAX': 0x10 }, Mem()) is None
+
+        insn = mk_insn(0, I_STR, mk_reg('R_EAX'), c = mk_reg('R_ECX'), flags = IOPT_ASM_END)
+        insn.set_attr(IATTR_NEXT, ( 0x30, 0 ))
+
+        # check instruction with next address loaded from JSON
+        fn_json = BasicBlock([ Insn(InsnJson().to_json(insn)) ]).compile_concrete()
+        assert tuple(fn_json({ 'R_EAX': 1 }, Mem())) == ( 0x30, 0 )
+
+        regs, mem = { 'R_EAX': 5, 'R_ECX': 6, 'R_EDX': 0x1000 }, Mem()
+
+        # jump is taken
+        assert fn(regs, mem) == ( 0x20, 0 )
+        assert regs['R_EAX'] == regs['R_ECX'] == mem[0x1000] == 11
+        assert regs['R_EBX'] == 0xfffffffe and regs['V_01'] == 1
+
+        regs = { 'R_EAX': 0xffffffff, 'R_ECX': 0x11, 'R_EDX': 0x1000 }
+
+        # jump is not taken
+        assert fn(regs, mem) == ( 0x12, 0 )
+        assert regs['R_EAX'] == 0x10 and regs['V_01'] == 0
+
 
 class Func(InsnList):
 
@@ -1028,6 +1543,9 @@ class Func(InsnList):
         self.bb_list, self.chunks = [], []
         self.stack_args = None
 
+        # IR addresses of added basic blocks and instructions
+        self.bb_addrs, self.insn_addrs = set(), set()
+
     def __str__(self):
 
         return self.to_str(show_header = True, show_chunks = True)
@@ -1046,7 +1564,7 @@ class Func(InsnList):
 
             if show_chunks:
 
-                ret += '; Code chunks: %s\n' % ', '.join(map(lambda c: str(c), self.chunks))
+                ret += '; Code chunks: %s\n' % ', '.join(map(str, self.chunks))
 
             ret += '; ' + '-' * 32 + '\n'
 
@@ -1113,7 +1631,7 @@ class Func(InsnList):
 
     def add_bb(self, bb):
 
-        if not bb in self.bb_list:
+        if not bb.ir_addr in self.bb_addrs:
 
             if bb.ir_addr == ( self.addr, 0 ):
 
@@ -1132,11 +1650,15 @@ class Func(InsnList):
             # update code chunks and basic blocks information
             self.add_chunk(bb.first.addr, bb.size)
             self.bb_list.append(bb) 
+            self.bb_addrs.add(bb.ir_addr)
             
             for insn in bb:
 
                 # add bb instruction to func instructions list
-                if not insn in self: self.append(insn)            
+                if not insn.ir_addr() in self.insn_addrs: 
+
+                    self.insn_addrs.add(insn.ir_addr())
+                    self.append(insn)            
 
     def name(self):
 
@@ -1177,7 +1699,7 @@ class GraphNode(object):
     def __init__(self, item = None):
 
         self.item = item
-        self.in_edges, self.out_edges = Set(), Set()
+        self.in_edges, self.out_edges = set(), set()
 
     def _find_edge(self, edges, name):
 
@@ -1243,7 +1765,7 @@ class Graph(object):
 
     def reset(self): 
 
-        self.nodes, self.edges = {}, Set()   
+        self.nodes, self.edges = {}, set()   
 
     def node(self, key):
 
@@ -1263,9 +1785,9 @@ class Graph(object):
 
         node = item if isinstance(item, self.NODE) else self.NODE(item)
 
-        edges = Set()
-        edges.union_update(node.in_edges)
-        edges.union_update(node.out_edges)
+        edges = set()
+        edges.update(node.in_edges)
+        edges.update(node.out_edges)
 
         # delete node edges
         for edge in edges: self.del_edge(edge)
@@ -1329,7 +1851,7 @@ class Graph(object):
                 name, attr = str(edge), {}
                 if len(name) > 0: attr['label'] = '"%s"' % name
 
-                attr = ' '.join(map(lambda a: '%s=%s' % a, attr.items()))
+                attr = ' '.join([ '%s=%s' % a for a in attr.iteritems() ])
 
                 if edge.node_from.present_in_dot_graph() and \
                    edge.node_to.present_in_dot_graph():
@@ -1415,6 +1937,12 @@ class CFGraphBuilder(object):
         self.arch = storage.arch
         self.storage = storage
 
+        #
+        # Already built basic blocks by IR address. Builders are created for 
+        # single traversal, so storage is not modified while cache is alive.
+        #
+        self._bb_cache = {}
+
     is_thumb = lambda self, addr: self.arch == arm and (addr & 1) == 1
 
     def process_node(self, bb, state, context): 
@@ -1432,7 +1960,7 @@ class CFGraphBuilder(object):
         while True:
 
             # translate single assembly instruction
-            insn_list += self.get_insn(addr)
+            insn_list.extend(self.get_insn(addr))
             insn = insn_list[-1]
 
             addr += insn.size
@@ -1464,22 +1992,26 @@ class CFGraphBuilder(object):
         addr, inum = ir_addr
 
         inum = 0 if inum is None else inum
-        last = inum
+
+        # check for already built basic block
+        try: return self._bb_cache[( addr, inum )]
+        except KeyError: pass
 
         # translate assembly basic block at given address
         insn_list = self._get_bb(addr)
 
         # split it into the IR basic blocks
-        for insn in insn_list[inum:]:
+        for last in xrange(inum, len(insn_list)):
 
-            last += 1
-            if insn.has_flag(IOPT_BB_END): 
+            if insn_list[last].has_flag(IOPT_BB_END): 
 
-                return BasicBlock(insn_list[inum:last])
+                bb = self._bb_cache[( addr, inum )] = BasicBlock(insn_list[inum : last + 1])
+                return bb
 
     def traverse(self, ir_addr, state = None, context = None):
 
-        stack, nodes, edges = [], [], []
+        # sets are used for membership checks, list keeps edges order
+        stack, nodes, edges, edges_list = [], set(), set(), []
         cfg = CFGraph()
 
         ir_addr = ir_addr if isinstance(ir_addr, tuple) else (ir_addr, None)        
@@ -1489,12 +2021,15 @@ class CFGraphBuilder(object):
 
             if bb.ir_addr not in nodes: 
 
-                nodes.append(bb.ir_addr)
+                nodes.add(bb.ir_addr)
                 self.process_node(bb, state, context)
 
         def _process_edge(edge):
 
-            if edge not in edges: edges.append(edge)
+            if edge not in edges: 
+
+                edges.add(edge)
+                edges_list.append(edge)
 
         # iterative pre-order CFG traversal
         while True:
@@ -1527,7 +2062,7 @@ class CFGraphBuilder(object):
             except IndexError: break
 
         # add processed edges to the CFG
-        for edge in edges: cfg.add_edge(*edge)
+        for edge in edges_list: cfg.add_edge(*edge)
             
         return cfg
 
@@ -1556,9 +2091,11 @@ class TestCFGraphBuilder(unittest.TestCase):
         print '\n', self.storage
 
         # translate basic block
-        bb = CFGraphBuilder(self.storage).get_bb(0)
+        builder = CFGraphBuilder(self.storage)
+        bb = builder.get_bb(0)
         
         assert len(bb) == 3
+        assert builder.get_bb(( 0, 0 )) is bb
         assert bb.get_successors() == (( 0, 3 ), ( 2, 0 ))
 
         assert bb.last.op == I_JCC and bb.last.ir_addr() == ( 0, 2 )
@@ -1652,7 +2189,7 @@ class DFGraph(Graph):
         self.add_node(self.entry_node)
         self.add_node(self.exit_node)
 
-        self.deleted_nodes = Set()
+        self.deleted_nodes = set()
 
     def del_node(self, node):
 
@@ -1663,7 +2200,7 @@ class DFGraph(Graph):
 
     def store(self, storage):
 
-        addr_list = Set()
+        addr_list = set()
 
         for node in self.nodes.values() + list(self.deleted_nodes): 
 
@@ -2098,7 +2635,7 @@ class DFGraphBuilder(object):
             
             if not bb.input.has_key(var): 
 
-                bb.input[var] = Set()
+                bb.input[var] = set()
 
             if not ir_addr in bb.input[var]: 
 
@@ -2235,11 +2772,11 @@ class TestDFGraphBuilder(unittest.TestCase):
         # construct DFG 
         dfg = DFGraphBuilder(self.storage).traverse(0)
 
-        edges = Set(map(lambda e: str(e), dfg.entry_node.out_edges))
-        assert edges == Set([ 'R_ESP', 'R_EDI', 'R_ESI', 'R_ECX', 'R_DFLAG' ])
+        edges = set(map(lambda e: str(e), dfg.entry_node.out_edges))
+        assert edges == set([ 'R_ESP', 'R_EDI', 'R_ESI', 'R_ECX', 'R_DFLAG' ])
 
-        edges = Set(map(lambda e: str(e), dfg.exit_node.in_edges))
-        assert edges.issuperset(Set([ 'R_ESP', 'R_EDI', 'R_ESI', 'R_ECX' ]))        
+        edges = set(map(lambda e: str(e), dfg.exit_node.in_edges))
+        assert edges.issuperset(set([ 'R_ESP', 'R_EDI', 'R_ESI', 'R_ECX' ]))        
 
     def test_optimizations(self):
 
@@ -2254,16 +2791,16 @@ class TestDFGraphBuilder(unittest.TestCase):
         # construct DFG 
         dfg = DFGraphBuilder(self.storage).traverse(0)
 
-        edges = Set(map(lambda e: str(e), dfg.exit_node.in_edges))
-        assert edges.issuperset(Set([ 'R_OF', 'R_ZF', 'R_CF', 'R_AF', 'R_PF', 'R_SF', \
+        edges = set(map(lambda e: str(e), dfg.exit_node.in_edges))
+        assert edges.issuperset(set([ 'R_OF', 'R_ZF', 'R_CF', 'R_AF', 'R_PF', 'R_SF', \
                                       'R_ECX', 'R_EDX', 'R_ESP' ]))
 
         # run constants and dead code optimizations
         dfg.eliminate_dead_code()
         dfg.constant_folding()
 
-        edges = Set(map(lambda e: str(e), dfg.exit_node.in_edges))
-        assert edges == Set([ 'R_ECX', 'R_EDX', 'R_ESP' ])
+        edges = set(map(lambda e: str(e), dfg.exit_node.in_edges))
+        assert edges == set([ 'R_ECX', 'R_EDX', 'R_ESP' ])
 
         # update storage
         storage = CodeStorageMem(self.arch)
@@ -2380,14 +2917,16 @@ class CodeStorageMem(CodeStorage):
 
     def __iter__(self):
 
-        keys = self.items.keys()
-        keys.sort()
+        # copy addresses list, storage can be modified during iteration
+        for addr in self.addr_list[:]:
+
+            insn_list = self.items.get(addr, {})
 
-        for k in keys: yield Insn(self._get_insn(k))   
+            for inum in sorted(insn_list.keys()): yield Insn(insn_list[inum])
 
     def __str__(self):
 
-        return '\n'.join(map(lambda insn: str(insn), self))
+        return '\n'.join(map(str, self))
 
     def _get_key(self, insn):
 
@@ -2395,25 +2934,54 @@ class CodeStorageMem(CodeStorage):
 
     def _get_insn(self, ir_addr):
         
-        try: return self.items[ir_addr]
+        addr, inum = ir_addr
+
+        try: return self.items[addr][inum]
         except KeyError: raise StorageError(*ir_addr)    
 
     def _del_insn(self, ir_addr):
 
-        try: return self.items.pop(ir_addr)
+        addr, inum = ir_addr
+
+        try: insn = self.items[addr].pop(inum)
         except KeyError: raise StorageError(*ir_addr)
 
+        if len(self.items[addr]) == 0:
+
+            # last IR instruction of machine instruction was deleted
+            self.items.pop(addr)
+            self.addr_list.pop(bisect.bisect_left(self.addr_list, addr))
+
+        self.count -= 1
+
+        return insn
+
     def _put_insn(self, insn):
 
-        self.items[self._get_key(insn)] = insn        
+        addr, inum = self._get_key(insn)
+
+        try: 
+
+            insn_list = self.items[addr]
+
+        except KeyError:
+
+            # keep list of machine instructions addresses sorted
+            insn_list = self.items[addr] = {}
+            bisect.insort(self.addr_list, addr)
+
+        if not insn_list.has_key(inum): self.count += 1
+
+        insn_list[inum] = insn
     
     def clear(self): 
 
-        self.items = {}
+        # IR instructions by address and inum
+        self.items, self.addr_list, self.count = {}, [], 0
 
     def size(self): 
 
-        return len(self.items)
+        return self.count
 
     def get_insn(self, ir_addr): 
 
@@ -2474,17 +3042,21 @@ class CodeStorageMem(CodeStorage):
 
     def to_file(self, path):
 
+        js = InsnJson()
+
         with open(path, 'w') as fd:
 
             # dump all instructions as json
-            for insn in self: fd.write(InsnJson().to_json(insn) + '\n')
+            fd.writelines(js.to_json(insn) + '\n' for insn in self)
 
     def from_file(self, path):
 
+        js = InsnJson()
+
         with open(path) as fd:        
         
             # load instructions from json
-            for data in fd: self._put_insn(InsnJson().from_json(data))
+            for data in fd: self._put_insn(js.from_json(data))
 
     def to_storage(self, other):
 
@@ -2619,6 +3191,9 @@ class CodeStorageTranslator(CodeStorage):
 
     translator_postprocess = []
 
+    # max. number of machine instructions of basic block to translate ahead
+    TRANSLATE_AHEAD = 16
+
     class CFGraphBuilderFunc(CFGraphBuilder):
 
         def process_node(self, bb, state, context):
@@ -2878,7 +3453,7 @@ class CodeStorageTranslator(CodeStorage):
             return insn_list
 
         # unserialize instructions list
-        insn_list = map(lambda insn: Insn(insn), insn_list)
+        insn_list = map(Insn, insn_list)
 
         # build dataflow graph for single machine instruction
         dfg = DFGraphBuilder(self).from_insn(insn_list)  
@@ -2923,7 +3498,7 @@ class CodeStorageTranslator(CodeStorage):
         while _cleanup() > 0: pass            
 
         # get IR addresses of removed instructions
-        removed = map(lambda node: node.item.ir_addr(), removed)            
+        removed = [ node.item.ir_addr() for node in removed ]            
 
         ret, inum = [], 0
 
@@ -2941,7 +3516,7 @@ class CodeStorageTranslator(CodeStorage):
         ret[0].attr, ret[-1].attr = insn_list[0].attr, insn_list[-1].attr
 
         # serialize instructions list back
-        return map(lambda insn: insn.serialize(), ret)
+        return [ insn.serialize() for insn in ret ]
 
     def _postprocess_unknown(self, addr, insn_list):
         ''' Convert untranslated instruction representation into the 
@@ -3006,19 +3581,7 @@ class CodeStorageTranslator(CodeStorage):
 
         return self.storage.size()
 
-    def get_insn(self, ir_addr):        
-
-        ir_addr = ir_addr if isinstance(ir_addr, tuple) else (ir_addr, None)
-        addr, inum = ir_addr
-
-        try:
-
-            # query already translated IR instructions for this address
-            return self.storage.get_insn(ir_addr)
-
-        except StorageError:
-
-            pass
+    def _translate(self, addr):
 
         if self.arch == arm:
 
@@ -3026,9 +3589,7 @@ class CodeStorageTranslator(CodeStorage):
             # We need to clear least significant bit of instruction address 
             # in case of ARM Thumb mode.
             #
-            real_addr, _ = self._arm_addr_decode(ir_addr[0])
-
-            ir_addr = ( real_addr, inum )   
+            real_addr, _ = self._arm_addr_decode(addr)
 
         else:     
 
@@ -3044,13 +3605,65 @@ class CodeStorageTranslator(CodeStorage):
         # Please note, that in case of ARM we need to pass 
         # a memory address with thumb enabled/disabled bit included.
         #
-        ret = InsnList()
-        
-        for insn in self.translate_insn(data, addr):
+        ret = self.translate_insn(data, addr)
+
+        # save translated instructions
+        self.storage.put_insn(ret)
+
+        return ret
+
+    def _translate_ahead(self, insn):
+
+        #
+        # Instructions of basic block are going to be requested anyway, 
+        # translate them while we're here to save get_insn() calls that 
+        # are missing the storage.
+        #
+        for i in range(self.TRANSLATE_AHEAD):
+
+            if insn.has_flag(IOPT_BB_END): break
+
+            addr = insn.next_asm()
+
+            try: 
+
+                # check if next instruction was already translated
+                self.storage.get_insn(( addr, 0 ))
+                break
+
+            except StorageError: 
+
+                pass
+
+            try: 
+
+                insn = Insn(self._translate(addr)[-1])
+
+            except Exception: 
+
+                #
+                # Readers might raise their own exceptions (GDB, pykd, etc.), 
+                # error will be reported when instruction will be requested.
+                #
+                break
 
-            # save translated instructions
-            self.storage.put_insn(insn)
-            ret.append(Insn(insn))
+    def get_insn(self, ir_addr):        
+
+        ir_addr = ir_addr if isinstance(ir_addr, tuple) else (ir_addr, None)
+        addr, inum = ir_addr
+
+        try:
+
+            # query already translated IR instructions for this address
+            return self.storage.get_insn(ir_addr)
+
+        except StorageError:
+
+            pass
+
+        ret = InsnList(map(Insn, self._translate(addr)))
+
+        self._translate_ahead(ret[-1])
 
         return ret if inum is None else ret[inum]
 
@@ -3114,6 +3727,62 @@ class TestCodeStorageTranslator(unittest.TestCase):
 
         print '\n', self.tr.get_insn(0)
 
+    def test_translate_ahead(self):
+
+        addrs = lambda tr: sorted(set([ insn.addr for insn in tr.storage ]))
+
+        # xor eax, eax ; inc eax ; ret ; nop
+        tr = CodeStorageTranslator(ReaderRaw(ARCH_X86, '\x33\xC0\x40\xC3\x90'))
+        tr.get_insn(0)
+
+        # check that translation stops at the end of basic block
+        assert addrs(tr) == [ 0, 2, 3 ]
+
+        # xor eax, eax ; inc eax
+        tr = CodeStorageTranslator(ReaderRaw(ARCH_X86, '\x33\xC0\x40'))
+
+        # read error must be reported only when instruction is requested
+        assert len(tr.get_insn(0)) > 0 and addrs(tr) == [ 0, 2 ]
+
+        try:
+
+            tr.get_insn(3)
+            assert False
+
+        except ReadError: pass
+
+        class Reader(ReaderRaw):
+
+            def read(self, addr, size):
+
+                # reader that has its own exceptions
+                if addr > 0: raise RuntimeError()
+
+                return ReaderRaw.read(self, addr, size)
+
+        # xor eax, eax ; inc eax
+        tr = CodeStorageTranslator(Reader(ARCH_X86, '\x33\xC0\x40'))
+
+        assert len(tr.get_insn(0)) > 0 and addrs(tr) == [ 0 ]
+
+        # nop * 32 ; ret
+        tr = CodeStorageTranslator(ReaderRaw(ARCH_X86, '\x90' * 0x20 + '\xC3'))
+        tr.get_insn(0)
+
+        # check for the number of instructions to translate ahead
+        assert addrs(tr) == range(tr.TRANSLATE_AHEAD + 1)
+
+        tr = CodeStorageTranslator(ReaderRaw(ARCH_X86, '\x90' * 0x20 + '\xC3'))
+        tr.get_insn(2)
+
+        translated, translate = [], tr._translate
+        tr._translate = lambda addr: translated.append(addr) or translate(addr)
+
+        tr.get_insn(0)
+
+        # check that already translated instruction stops translation
+        assert translated == [ 0, 1 ] and addrs(tr) == range(tr.TRANSLATE_AHEAD + 3)
+
     def test_get_bb(self):
 
         print '\n', self.tr.get_bb(0)
@@ -212,14 +212,14 @@ class Mem(object):
         def quoted(data):
 
             # replace non-alphanumeric characters
-            return ''.join(map(lambda b: b if b.isalnum() else '.', data))
+            return ''.join([ b if b.isalnum() else '.' for b in data ])
 
         while data:
 
             line = data[: width]
             data = data[width :]
 
-            s = map(lambda b: '%.2x' % ord(b), line)
+            s = [ '%.2x' % ord(b) for b in line ]
             s += [ '  ' ] * (width - len(line))
 
             s = '%s | %s' % (' '.join(s), quoted(line))
@@ -874,8 +874,8 @@ class Abi(object):
     def initial_regs(self):
 
         regs = {}
-        regs.update(map(lambda name: (name, 0L), self.arch.Registers.general + \
-                                                 self.arch.Registers.flags))
+        regs.update([ ( name, 0L ) for name in self.arch.Registers.general + \
+                                               self.arch.Registers.flags ])
         return regs
 
     def reset(self):
@@ -0,0 +1,61 @@
+
+# Optional compiled versions of the hottest pyopenreil helpers, REIL.py and
+# symbolic.py fall back to their pure Python code when this module is missing.
+
+# REIL_NAMES_SIZE order from IR.py
+DEF U1  = 0
+DEF U64 = 4
+
+cdef unsigned long long SIZE_MASK[5]
+
+SIZE_MASK[:] = [ 0x1, 0xff, 0xffff, 0xffffffff, 0xffffffffffffffff ]
+
+# SymAny and SymExp classes, see init()
+cdef object SymAny = None
+cdef object SymExp = None
+cdef frozenset commutative = frozenset()
+
+def init(sym_any, sym_exp):
+
+    global SymAny, SymExp, commutative
+
+    SymAny, SymExp = sym_any, sym_exp
+    commutative = frozenset(sym_exp.commutative)
+
+cpdef object get_val(object val, int size):
+    ''' Arg.get_val() for A_CONST argument value and size. '''
+
+    cdef unsigned long long ret
+
+    if size < U1 or size > U64: raise KeyError(size)
+
+    # Python long can be negative or wider than 64 bits
+    ret = (val & 0xffffffffffffffff) & SIZE_MASK[size]
+
+    if size == U1: return 1 if ret != 0 else 0
+
+    return long(ret)
+
+cpdef bint exp_eq(object a, object b) except -1:
+    ''' SymExp.__eq__() that walks nested expressions without
+        going back to the interpreter. '''
+
+    if a is b: return True
+    if type(b) is SymAny: return True
+
+    if type(a) is not SymExp:
+
+        # leaf node or None operand of unary expression
+        return a == b
+
+    if type(b) is not SymExp: return False
+    if a.op != b.op: return False
+
+    if exp_eq(a.a, b.a) and exp_eq(a.b, b.b): return True
+
+    if a.op in commutative:
+
+        # equation for commutative operations
+        return exp_eq(a.b, b.a) and exp_eq(a.a, b.b)
+
+    return False
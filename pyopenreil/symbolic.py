@@ -1,7 +1,36 @@
+import weakref, itertools
+from collections import OrderedDict
+
+try:
+
+    # required for SymProgram
+    import numpy
+
+except ImportError: 
+
+    numpy = None
+
+try:
+
+    # optional compiled helpers, see src/_reil_core.pyx
+    import _reil_core
+
+except ImportError:
+
+    _reil_core = None
+
 from REIL import *
 
+class SymError(Exception):
+
+    pass
+
+
 class Sym(object):
 
+    # weak references are used by intern table
+    __slots__ = ( '__weakref__', )
+
     def __init__(self):
 
         pass    
@@ -100,7 +129,7 @@ class Sym(object):
 
     def to_exp(self, op, arg = None):
 
-        return SymExp(op, self, arg)      
+        return mk_exp(op, self, arg)      
 
     def parse(self, visitor):
 
@@ -109,6 +138,12 @@ class Sym(object):
 
 class SymAny(Sym):
 
+    __slots__ = ()
+
+    # SymAny is equal to any other value, so it can't have a hash that is
+    # consistent with __eq__(), use it only as a pattern for comparison.
+    __hash__ = None
+
     def __str__(self):
 
         return '@'
@@ -121,13 +156,11 @@ class SymAny(Sym):
 
         return False
 
-    def __hash__(self):
-
-        return hash(str(self))
-
 
 class SymVal(Sym):
 
+    __slots__ = ( 'name', 'size', 'is_temp' )
+
     def __init__(self, name, size = None, is_temp = False):
 
         self.name, self.size = name, size
@@ -151,6 +184,8 @@ class SymVal(Sym):
 
 class SymPtr(Sym):
 
+    __slots__ = ( 'val', 'size' )
+
     def __init__(self, val, size = None):
 
         self.val, self.size = val, size
@@ -161,6 +196,7 @@ class SymPtr(Sym):
 
     def __eq__(self, other):
 
+        if self is other: return True
         if type(other) == SymAny: return True
         if type(other) != SymPtr: return False
 
@@ -172,13 +208,18 @@ class SymPtr(Sym):
 
     def parse(self, visitor):
 
-        self.val = self.val.parse(visitor)
+        val = self.val.parse(visitor)
 
-        return visitor(self)
+        # interned expressions are shared, don't modify them in place
+        ptr = self if val is self.val else mk_ptr(val, self.size)
+
+        return visitor(ptr)
 
 
 class SymConst(Sym):
 
+    __slots__ = ( 'val', 'size' )
+
     def __init__(self, val, size = None):
 
         self.val, self.size = val, size
@@ -201,6 +242,8 @@ class SymConst(Sym):
 
 class SymIRAddr(Sym):
 
+    __slots__ = ( 'addr', 'inum' )
+
     def __init__(self, addr, inum):
 
         self.addr, self.inum = addr, inum
@@ -223,6 +266,8 @@ class SymIRAddr(Sym):
 
 class SymIP(Sym):
 
+    __slots__ = ()
+
     def __str__(self):
 
         return '@IP'
@@ -238,6 +283,8 @@ class SymIP(Sym):
 
 class SymCond(Sym):
 
+    __slots__ = ( 'cond', 'true', 'false' )
+
     def __init__(self, cond, true, false):
 
         self.cond, self.true, self.false = cond, true, false
@@ -262,20 +309,28 @@ class SymCond(Sym):
 
     def parse(self, visitor):        
         
-        self.cond = self.cond.parse(visitor)
-        self.true = self.true.parse(visitor)
-        self.false = self.false.parse(visitor)
+        cond = self.cond.parse(visitor)
+        true = self.true.parse(visitor)
+        false = self.false.parse(visitor)
+
+        if cond is not self.cond or true is not self.true or false is not self.false:
+
+            return visitor(SymCond(cond, true, false))
 
         return visitor(self)
 
 
 class SymExp(Sym):
 
-    commutative = ( I_ADD, I_SUB, I_AND, I_XOR, I_OR )
+    # hash is calculated once, on first use
+    __slots__ = ( 'op', 'a', 'b', '_hash' )
+
+    commutative = frozenset(( I_ADD, I_AND, I_XOR, I_OR ))
 
     def __init__(self, op, a, b = None):
         
         self.op, self.a, self.b = op, a, b
+        self._hash = None
 
     def __str__(self):
 
@@ -296,6 +351,9 @@ class SymExp(Sym):
 
     def __eq__(self, other):
 
+        if _reil_core is not None: return _reil_core.exp_eq(self, other)
+
+        if self is other: return True
         if type(other) == SymAny: return True
         if type(other) != SymExp: return False
 
@@ -310,14 +368,278 @@ class SymExp(Sym):
 
     def __hash__(self):
 
-        return hash(self.op) ^ hash(self.a) ^ hash(self.b)
+        if self._hash is None:
+
+            if self.op in self.commutative:
+
+                # must be the same for (a op b) and (b op a)
+                self._hash = hash(( self.op, ) + tuple(sorted(( hash(self.a), hash(self.b) ))))
+
+            else:
+
+                self._hash = hash(( self.op, self.a, self.b ))
+
+        return self._hash
 
     def parse(self, visitor):        
         
-        if self.a is not None: self.a = self.a.parse(visitor)
-        if self.b is not None: self.b = self.b.parse(visitor)
+        a = self.a if self.a is None else self.a.parse(visitor)
+        b = self.b if self.b is None else self.b.parse(visitor)
 
-        return visitor(self)
+        # interned expressions are shared, don't modify them in place
+        exp = self if a is self.a and b is self.b else mk_exp(self.op, a, b)
+
+        return visitor(exp)
+
+    def linearize(self):
+
+        return SymProgram(self)
+
+
+if _reil_core is not None: _reil_core.init(SymAny, SymExp)
+
+
+def _eval_prog(ops, A, B, regs, masks):
+
+    # operation results are stored at the end of registers file
+    base = len(regs) - len(ops)
+
+    for i in range(len(ops)):
+
+        op, a, b = ops[i], regs[A[i]], regs[B[i]]
+
+        if (op == I_DIV or op == I_MOD) and b == 0: 
+
+            raise ZeroDivisionError('SymProgram division by zero')
+
+        if op == I_ADD:   r = a + b
+        elif op == I_SUB: r = a - b
+        elif op == I_NEG: r = ~a + numpy.uint64(1)
+        elif op == I_MUL: r = a * b
+        elif op == I_DIV: r = a // b
+        elif op == I_MOD: r = a % b
+        elif op == I_SHL: r = a << b if b < 64 else numpy.uint64(0)
+        elif op == I_SHR: r = a >> b if b < 64 else numpy.uint64(0)
+        elif op == I_AND: r = a & b
+        elif op == I_OR:  r = a | b
+        elif op == I_XOR: r = a ^ b
+        elif op == I_NOT: r = ~a
+        elif op == I_EQ:  r = numpy.uint64(1) if a == b else numpy.uint64(0)
+        else:             r = numpy.uint64(1) if a < b else numpy.uint64(0)
+
+        regs[base + i] = r & masks[base + i]
+
+
+# _eval_prog() compiled with numba, False if numba is not available
+_eval_prog_jit = None
+
+def _eval_prog_get():
+
+    global _eval_prog_jit
+
+    if _eval_prog_jit is None:
+
+        try:
+
+            from numba import njit
+
+            _eval_prog_jit = njit(cache = True)(_eval_prog)
+
+        except ImportError: 
+
+            _eval_prog_jit = False
+
+    return _eval_prog_jit
+
+
+# operations for Python integers, results are masked by the caller
+_eval_ops = { I_ADD: lambda a, b: a + b,  I_SUB: lambda a, b: a - b,
+              I_NEG: lambda a, b: -a,     I_MUL: lambda a, b: a * b,
+              I_DIV: lambda a, b: a / b,  I_MOD: lambda a, b: a % b,
+              I_SHL: lambda a, b: a << b, I_SHR: lambda a, b: a >> b,
+              I_AND: lambda a, b: a & b,   I_OR: lambda a, b: a | b,
+              I_XOR: lambda a, b: a ^ b,  I_NOT: lambda a, b: ~a,
+               I_EQ: lambda a, b: int(a == b), 
+               I_LT: lambda a, b: int(a < b) }
+
+def _eval_prog_py(ops, A, B, regs, masks):
+
+    # the same as _eval_prog() but for lists of Python integers
+    base = len(regs) - len(ops)
+
+    for i in range(len(ops)):
+
+        op, a, b = ops[i], regs[A[i]], regs[B[i]]
+
+        if (op == I_DIV or op == I_MOD) and b == 0: 
+
+            raise ZeroDivisionError('SymProgram division by zero')
+
+        regs[base + i] = _eval_ops[op](a, b) & masks[base + i]
+
+
+class SymProgram(object):
+    ''' Linearized form of the symbolic expression: flat list of operations
+        over the registers file that can be evaluated with concrete values of
+        input registers. Registers are holding constants, input values and 
+        results of the operations, last register is the expression value. '''
+
+    # supported operations
+    OPS = frozenset(( I_ADD, I_SUB, I_NEG, I_MUL, I_DIV, I_MOD, 
+                      I_SHL, I_SHR, I_AND, I_OR,  I_XOR, I_NOT, I_EQ, I_LT ))
+
+    def __init__(self, exp):
+
+        if numpy is None: raise SymError('numpy is required for SymProgram')
+
+        leaves, nodes, regs, sizes = [], [], {}, {}
+        self.inputs = {}
+
+        def _size(size):
+
+            return U64 if size is None else size
+
+        def _visit(node):
+
+            key = id(node)
+            if regs.has_key(key): return
+
+            if isinstance(node, SymExp) and node.op in self.OPS:
+
+                _visit(node.a)
+                if node.b is not None: _visit(node.b)
+
+                if node.op in [ I_EQ, I_LT ]: sizes[key] = U1
+                else: sizes[key] = sizes[id(node.a)]
+
+                regs[key] = None
+                nodes.append(node)
+
+            elif isinstance(node, SymVal):
+
+                if not self.inputs.has_key(node.name):
+
+                    # each input value has single register
+                    self.inputs[node.name] = len(leaves)
+                    leaves.append(( node, _size(node.size) ))
+
+                regs[key] = self.inputs[node.name]
+                sizes[key] = leaves[regs[key]][1]
+
+            elif isinstance(node, SymConst):
+
+                regs[key] = len(leaves)
+                sizes[key] = _size(node.size)
+                leaves.append(( node, sizes[key] ))
+
+            else:
+
+                raise SymError('Unable to linearize %s' % str(node))
+
+        _visit(exp)
+
+        # operations are going after constants and inputs
+        for n in range(len(nodes)): regs[id(nodes[n])] = len(leaves) + n
+
+        count = len(leaves) + len(nodes)
+        mask = lambda size: (1 << int(REIL_NAMES_SIZE[size])) - 1
+
+        self.ops = numpy.array([ node.op for node in nodes ], dtype = numpy.int8)
+        self.A = numpy.array([ regs[id(node.a)] for node in nodes ], dtype = numpy.int32)
+        self.B = numpy.array([ regs[id(node.a if node.b is None else node.b)] \
+                               for node in nodes ], dtype = numpy.int32)
+
+        self.consts = numpy.zeros(count, dtype = numpy.uint64)
+        self.masks = numpy.zeros(count, dtype = numpy.uint64)
+
+        for n in range(len(leaves)):
+
+            node, size = leaves[n]
+            self.masks[n] = mask(size)
+
+            if isinstance(node, SymConst): self.consts[n] = node.val & mask(size)
+
+        for n in range(len(nodes)):
+
+            self.masks[len(leaves) + n] = mask(sizes[id(nodes[n])])
+
+        # the same program for _eval_prog_py()
+        self.prog_py = ( self.ops.tolist(), self.A.tolist(), self.B.tolist(), 
+                         self.consts.tolist(), self.masks.tolist() )
+
+    def eval(self, inputs):
+        ''' Evaluate expression, inputs is a dict of input values names 
+            and their concrete values. '''
+
+        eval_prog = _eval_prog_get()
+
+        if not eval_prog:
+
+            # Python integers are faster than numpy scalars without numba
+            ops, A, B, regs, masks = self.prog_py
+            regs = regs[:]
+
+            for name, n in self.inputs.iteritems():
+
+                regs[n] = inputs[name] & masks[n]
+
+            _eval_prog_py(ops, A, B, regs, masks)
+
+            return long(regs[-1])
+
+        regs = self.consts.copy()
+
+        for name, n in self.inputs.items():
+
+            regs[n] = numpy.uint64(inputs[name] & long(self.masks[n]))
+
+        # unsigned integers wrap around, that's expected
+        with numpy.errstate(over = 'ignore'):
+
+            eval_prog(self.ops, self.A, self.B, regs, self.masks)
+
+        return long(regs[-1])
+
+
+#
+# Intern table that maps symbolic expression contents to the canonical 
+# instance, structurally equal expressions built with mk_*() functions 
+# are the same object. Sub-expressions are keyed by id() because they are
+# canonical instances too.
+#
+_intern = weakref.WeakValueDictionary()
+
+def _mk_interned(key, create):
+
+    try: 
+
+        return _intern[key]
+
+    except KeyError: 
+
+        ret = _intern[key] = create()
+        return ret
+
+def mk_val(name, size = None, is_temp = False):
+
+    return _mk_interned(( SymVal, name, size, is_temp ), 
+                        lambda: SymVal(name, size, is_temp = is_temp))
+
+def mk_const(val, size = None):
+
+    return _mk_interned(( SymConst, val, size ), 
+                        lambda: SymConst(val, size))
+
+def mk_ptr(val, size = None):
+
+    return _mk_interned(( SymPtr, id(val), size ), 
+                        lambda: SymPtr(val, size))
+
+def mk_exp(op, a, b = None):
+
+    # operands order is kept, commutative operations are handled by __eq__()
+    return _mk_interned(( SymExp, op, id(a), None if b is None else id(b) ), 
+                        lambda: SymExp(op, a, b))
 
 
 class TestSymExp(unittest.TestCase):    
@@ -332,74 +654,232 @@ class TestSymExp(unittest.TestCase):
 
         # check commutative operands
         assert a + b == b + a
-        assert a - b == b - a
         assert a & b == b & a
         assert a | b == b | a
         assert a ^ b == b ^ a
 
         # check non-commutative operands
+        assert a - b != b - a
         assert a * b != b * a
         assert a % b != b % a
         assert a / b != b / a
         assert a << b != b << a
         assert a >> b != b >> a
 
+    def test_hash(self):
+
+        a, b = SymVal('R_EAX', U32), SymVal('R_ECX', U32)
+
+        # equal expressions must have equal hashes
+        assert hash(a + b) == hash(b + a)
+        assert hash(a ^ b) == hash(b ^ a)
+
+        # check that both operands and their order are used
+        assert hash(a - b) != hash(b - a)
+        assert hash(a << b) != hash(b << a)
+        assert hash(a + a) != hash(b + b)
+
+        exp = a
+
+        # each level of this DAG uses previous one twice
+        for i in range(100): exp = exp + (exp ^ b)
+
+        # hash of shared sub-expression is calculated only once
+        assert hash(exp) == hash(exp)
+
+        try:
+
+            # SymAny can't be used as dict key
+            hash(SymAny())
+            assert False
+
+        except TypeError: pass
+
+    def test_intern(self):
+
+        # use names that other tests don't have in the intern table
+        a, b = mk_val('R_TEST_A', U32), mk_val('R_TEST_B', U32)
+        c = mk_val('R_TEST_C', U32)
+
+        # check that equal expressions are the same object
+        assert a is mk_val('R_TEST_A', U32) and a is not b
+        assert mk_const(1, U32) is mk_const(1, U32)
+        assert mk_ptr(a, U32) is mk_ptr(mk_val('R_TEST_A', U32), U32)
+        assert a + b is a + b and a + mk_const(1, U32) is a + mk_const(1, U32)
+        assert a << b is not b << a
+
+        # operands order doesn't depend on already existing expressions
+        exp = b + a
+        assert a + b is not exp and a + b == exp and str(a + b) == '(R_TEST_A + R_TEST_B)'
+
+        # parse() must not modify shared expressions
+        exp = a + b
+        ret = exp.parse(lambda e: c if e is b else e)
+
+        assert exp.b is b and ret is a + c
+
+    def test_linearize(self):
+
+        try:
+
+            import numpy
+
+        except ImportError, why: 
+
+            print '[!]', str(why)
+            return
+
+        a, b = SymVal('R_EAX', U32), SymVal('R_ECX', U32)
+        c = SymConst(0xffffffff, U32)
+
+        prog = ((a + b) * (a + b) ^ c).linearize()
+
+        # check for deduplicated registers and operations
+        assert len(prog.ops) == 3 and len(prog.consts) == 6
+
+        assert prog.eval({ 'R_EAX': 1, 'R_ECX': 2 }) == 9 ^ 0xffffffff
+        assert prog.eval({ 'R_EAX': 0x10000, 'R_ECX': 0 }) == 0xffffffff
+
+        prog = (SymExp(I_EQ, a - b, SymConst(0xffffffff, U32))).linearize()
+
+        assert prog.eval({ 'R_EAX': 1, 'R_ECX': 2 }) == 1
+        assert prog.eval({ 'R_EAX': 2, 'R_ECX': 1 }) == 0
+
+        prog = (a / b).linearize()
+
+        assert prog.eval({ 'R_EAX': 7, 'R_ECX': 2 }) == 3
+
+        try:
+
+            prog.eval({ 'R_EAX': 7, 'R_ECX': 0 })
+            assert False
+
+        except ZeroDivisionError: pass
+
+        for exp in [ SymExp(I_SMUL, a, b), SymPtr(a) + c ]:
+
+            try:
+
+                # signed operations and memory reads are not supported
+                exp.linearize()
+                assert False
+
+            except SymError: pass
+
 
 class SymState(object):
 
+    #
+    # State is a chain of layers, each layer is an ordered dict that maps
+    # values to expressions. Layers that have children are never modified, 
+    # so clone() is O(1): current and cloned state are getting new empty 
+    # layers on top of the shared one. Each layer has unique stamp.
+    #
+    __slots__ = ( 'parent', 'items', 'depth', 'stamp' )
+
+    stamps = itertools.count()
+
+    # flatten shared layers when chain is longer than this
+    MAX_DEPTH = 32
+
+    # marker for values that was removed from state
+    REMOVED = object()
+
     def __init__(self, other = None):
 
+        self.stamp = next(self.stamps)
+
         if other is None: self.clear()
-        else: self.state = [] + other.state
+        else: self._init_child(other._freeze())
+
+    def _init_child(self, parent):
+
+        self.parent, self.items = parent, OrderedDict()
+        self.depth = parent.depth + 1
+
+    def _freeze(self):
+
+        if len(self.items) == 0 and self.parent is not None:
+
+            # current state has no own changes, its parent is already frozen
+            return self.parent
+
+        # move current layer into the new shared parent
+        parent = SymState()
+        parent.parent, parent.items, parent.depth = self.parent, self.items, self.depth
+
+        if parent.depth >= self.MAX_DEPTH: parent._flatten()
+
+        self._init_child(parent)
+
+        return parent
+
+    def _merge(self):
+
+        ret = OrderedDict() if self.parent is None else self.parent._merge()
+
+        for val, exp in self.items.iteritems():
+
+            if exp is self.REMOVED: ret.pop(val, None)
+            else: ret[val] = exp
+
+        return ret
+
+    def _flatten(self):
+
+        if self.parent is not None:
+
+            # replace layers chain with single layer
+            self.items = self._merge()
+            self.parent, self.depth = None, 0
 
     def __getitem__(self, target_val):
 
+        state = self
+
         try:
 
-            # get expression by value name
-            return next(exp for val, exp in self.state if val == target_val)
+            while state is not None:
 
-        except StopIteration:
+                # get expression from the topmost layer that has given value
+                exp = state.items.get(target_val, None)
+                if exp is self.REMOVED: break
+                if exp is not None: return exp
 
-            raise KeyError()
+                state = state.parent
 
-    def __setitem__(self, val, exp):
+        except TypeError:
+
+            # unhashable pattern (like SymAny), compare it with each value
+            for val, exp in self:
 
-        for i in range(len(self.state)):
+                if val == target_val: return exp
 
-            current_val, current_exp = self.state[i]
-            if current_val == val:
+        raise KeyError()
 
-                self.state[i] = ( val, exp )
-                return
+    def __setitem__(self, val, exp):
 
-        self.state.append(( val, exp ))
+        self.items[val] = exp
 
     def __iter__(self):
 
-        for val, exp in self.state: yield val, exp
+        for val, exp in self._merge().items(): yield val, exp
 
     def __str__(self):
 
-        return '\n'.join(map(lambda item: '%s = %s' % item, self.state))
+        return '\n'.join([ '%s = %s' % item for item in self ])
 
     def clear(self, val = None):
 
         if val is not None:
 
-            for i in range(len(self.state)):
-
-                current_val, current_exp = self.state[i]
-                if current_val == val:
-
-                    # remove single variable from state
-                    self.state.pop(i)
-                    return
+            # remove single variable from state
+            if self.get(val) is not None: self.items[val] = self.REMOVED
 
         else:
 
             # clear state
-            self.state = []
+            self.parent, self.items, self.depth = None, OrderedDict(), 0
 
     def get(self, val):
 
@@ -439,7 +919,7 @@ class SymState(object):
 
     def arg_out(self):
 
-        return [ val for val, _ in self.state ]
+        return [ val for val, _ in self ]
 
     def update(self, val, exp):
 
@@ -447,11 +927,11 @@ class SymState(object):
 
     def update_mem_r(self, val, exp, size):
 
-        self.update(val, SymPtr(exp, size))
+        self.update(val, mk_ptr(exp, size))
 
     def update_mem_w(self, val, exp, size):
 
-        self.update(SymPtr(self.query(val), size), exp)
+        self.update(mk_ptr(self.query(val), size), exp)
 
     def clone(self):
 
@@ -491,6 +971,9 @@ class SymState(object):
 
                     if e in val_in: raise ValueFound()
 
+                    # expressions can be shared between states, keep them intact
+                    return e
+
                 try: 
 
                     exp.parse(_visitor)
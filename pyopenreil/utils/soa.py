@@ -0,0 +1,216 @@
+import unittest
+import numpy
+
+from pyopenreil import REIL
+
+class CodeStorageMemSoA(REIL.CodeStorageMem):
+    ''' In-memory IR instructions storage that keeps each instruction field
+        in a separate numpy array (structure of arrays), so bulk queries like
+        find_bb_ends() or ops_at() don't need to unserialize instructions. '''
+
+    # initial number of rows in columns
+    DEF_CAPACITY = 0x100
+
+    # instruction columns
+    COLUMNS = ( ( 'addrs',    numpy.uint64, () ),    # machine instruction address
+                ( 'sizes',    numpy.uint8,  () ),    # machine instruction length
+                ( 'inums',    numpy.uint16, () ),    # IR instruction number
+                ( 'ops',      numpy.uint8,  () ),    # operation code
+                ( 'flags',    numpy.uint32, () ),    # REIL flags
+                ( 'arg_type', numpy.uint8,  (3,) ),  # arguments type
+                ( 'arg_size', numpy.uint8,  (3,) ),  # arguments size
+                ( 'arg_val',  numpy.uint64, (3,) ),  # A_CONST value or A_LOC address
+                ( 'arg_inum', numpy.uint16, (3,) ),  # A_LOC inum
+                ( 'arg_name', object,       (3,) ),  # A_REG and A_TEMP name
+                ( 'attrs',    object,       () ) )   # other instruction attributes
+
+    def __iter__(self):
+
+        # sort rows by IR address
+        rows = numpy.lexsort(( self.inums[: self.count], self.addrs[: self.count] ))
+
+        # copy rows contents, storage can be modified during iteration
+        for insn in [ self._get_row(row) for row in rows ]: yield REIL.Insn(insn)
+
+    def _get_row(self, row):
+
+        def _arg(n):
+
+            t = int(self.arg_type[row, n])
+
+            if t == REIL.A_NONE:    return ()
+            elif t == REIL.A_CONST: return ( t, int(self.arg_size[row, n]), long(self.arg_val[row, n]) )
+            elif t == REIL.A_LOC:   return ( t, ( long(self.arg_val[row, n]), int(self.arg_inum[row, n]) ))
+            else:                   return ( t, int(self.arg_size[row, n]), self.arg_name[row, n] )
+
+        attr = dict(self.attrs[row])
+        attr[REIL.IATTR_FLAGS] = int(self.flags[row])
+
+        return (( long(self.addrs[row]), int(self.sizes[row]) ), int(self.inums[row]),
+                  int(self.ops[row]), ( _arg(0), _arg(1), _arg(2) ), attr )
+
+    def _set_row(self, row, insn):
+
+        attr = dict(REIL.Insn_attr(insn))
+
+        self.addrs[row], self.sizes[row] = REIL.Insn_addr(insn), REIL.Insn_size(insn)
+        self.inums[row], self.ops[row] = REIL.Insn_inum(insn), REIL.Insn_op(insn)
+        self.flags[row] = attr.pop(REIL.IATTR_FLAGS, 0)
+        self.attrs[row] = attr
+
+        for n, arg in enumerate(REIL.Insn_args(insn)):
+
+            t = REIL.A_NONE if len(arg) == 0 else REIL.Arg_type(arg)
+            self.arg_type[row, n], self.arg_size[row, n] = t, 0
+            self.arg_val[row, n], self.arg_inum[row, n], self.arg_name[row, n] = 0, 0, None
+
+            if t == REIL.A_CONST:
+
+                self.arg_size[row, n] = REIL.Arg_size(arg)
+                self.arg_val[row, n] = REIL.Arg_val(arg) & 0xffffffffffffffff
+
+            elif t == REIL.A_LOC:
+
+                self.arg_val[row, n], self.arg_inum[row, n] = REIL.Arg_loc(arg)
+
+            elif t != REIL.A_NONE:
+
+                self.arg_size[row, n] = REIL.Arg_size(arg)
+                self.arg_name[row, n] = REIL.Arg_name(arg)
+
+    def _grow(self):
+
+        capacity = max(self.DEF_CAPACITY, len(self.addrs) * 2)
+
+        for name, dtype, shape in self.COLUMNS:
+
+            column = numpy.zeros(( capacity, ) + shape, dtype = dtype)
+            column[: self.count] = getattr(self, name)[: self.count]
+
+            setattr(self, name, column)
+
+    def _get_insn(self, ir_addr):
+
+        try: return self._get_row(self.rows[ir_addr])
+        except KeyError: raise REIL.StorageError(*ir_addr)
+
+    def _del_insn(self, ir_addr):
+
+        try: row = self.rows.pop(ir_addr)
+        except KeyError: raise REIL.StorageError(*ir_addr)
+
+        insn, last = self._get_row(row), self.count - 1
+
+        if row != last:
+
+            # move last row into the place of deleted one
+            for name, dtype, shape in self.COLUMNS:
+
+                column = getattr(self, name)
+                column[row] = column[last]
+
+            self.rows[( long(self.addrs[row]), int(self.inums[row]) )] = row
+
+        self.attrs[last] = None
+        self.arg_name[last] = None
+        self.count -= 1
+
+        return insn
+
+    def _put_insn(self, insn):
+
+        ir_addr = REIL.Insn_ir_addr(insn)
+
+        try:
+
+            row = self.rows[ir_addr]
+
+        except KeyError:
+
+            if self.count == len(self.addrs): self._grow()
+
+            row = self.rows[ir_addr] = self.count
+            self.count += 1
+
+        self._set_row(row, insn)
+
+    def clear(self):
+
+        self.rows, self.count = {}, 0
+
+        for name, dtype, shape in self.COLUMNS:
+
+            setattr(self, name, numpy.zeros(( 0, ) + shape, dtype = dtype))
+
+    def size(self):
+
+        return self.count
+
+    def find_bb_ends(self):
+        ''' Get sorted IR addresses of all basic block end instructions. '''
+
+        rows = numpy.nonzero(self.flags[: self.count] & REIL.IOPT_BB_END)[0]
+
+        return sorted([ REIL.Insn.IRAddr(( long(self.addrs[row]), int(self.inums[row]) )) \
+                        for row in rows ])
+
+    def ops_at(self, first, last):
+        ''' Get opcodes of IR instructions in [first, last) address range
+            sorted by IR address. '''
+
+        rows = numpy.nonzero((self.addrs[: self.count] >= first) & \
+                             (self.addrs[: self.count] < last))[0]
+
+        rows = rows[numpy.lexsort(( self.inums[rows], self.addrs[rows] ))]
+
+        return self.ops[rows]
+
+
+class TestCodeStorageMemSoA(unittest.TestCase):
+
+    def setUp(self):
+
+        mk_insn = lambda op, addr, inum, flags, a = None, c = None: \
+                  REIL.Insn(op = op, size = 2, ir_addr = ( addr, inum ), a = a, c = c,
+                            attr = { REIL.IATTR_FLAGS: flags })
+
+        eax = REIL.Arg(REIL.A_REG, REIL.U32, 'R_EAX')
+
+        self.insn_list = [ mk_insn(REIL.I_STR, 2, 0, REIL.IOPT_ASM_END,
+                                   a = REIL.Arg(REIL.A_CONST, REIL.U32, val = 0xffffffff), c = eax),
+                           mk_insn(REIL.I_NONE, 0, 0, 0),
+                           mk_insn(REIL.I_JCC, 0, 1, REIL.IOPT_ASM_END | REIL.IOPT_BB_END,
+                                   a = eax, c = REIL.Arg(REIL.A_LOC, val = ( 2, 0 ))) ]
+
+        self.storage = CodeStorageMemSoA(REIL.ARCH_X86, insn_list = self.insn_list)
+
+    def test(self):
+
+        assert self.storage.size() == 3
+
+        # check for instructions order and contents
+        assert list(self.storage) == sorted(self.insn_list, key = lambda insn: insn.ir_addr())
+        assert self.storage.get_insn(( 0, 1 )).serialize() == self.insn_list[2].serialize()
+        assert len(self.storage.get_insn(0)) == 2
+
+        # check for column queries
+        assert self.storage.find_bb_ends() == [ ( 0, 1 ) ]
+        assert list(self.storage.ops_at(0, 2)) == [ REIL.I_NONE, REIL.I_JCC ]
+
+        # delete machine instruction
+        self.storage.del_insn(0)
+
+        assert self.storage.size() == 1 and self.storage.find_bb_ends() == []
+        assert self.storage.get_insn(( 2, 0 )) == self.insn_list[0]
+
+        for n in range(self.storage.DEF_CAPACITY * 2):
+
+            # check for storage capacity growth
+            self.storage.put_insn(REIL.Insn(op = REIL.I_NONE, size = 1, ir_addr = ( 0x100 + n, 0 )))
+
+        assert self.storage.size() == self.storage.DEF_CAPACITY * 2 + 1
+        assert self.storage.get_insn(( 2, 0 )) == self.insn_list[0]
+
+#
+# EoF
+#